@@ -1,19 +1,88 @@
 import io
+import math
+import signal
 import time
 from functools import wraps
-from typing import List
+from typing import List, Optional, Tuple
 from urllib.error import HTTPError
 
 import telebot
 from urllib3.exceptions import MaxRetryError
 
-from source.config import (BATCH_SIZE, FONT_COMMANDS, FONT_SIZES, IMAGES, MSG,
-                           SETTINGS, TOKEN)
-from source.storage import MinioClient
-from source.transformer import ImageTransformer
+from source.config import (ADMIN_IDS, BATCH_SIZE, CONTENT, FONT_COMMANDS,
+                           FONT_SIZES, IMAGES, MAX_FRAME_SIZE, MSG,
+                           PROFILE_SIGNAL_RATE, RECORD_UPDATES, RESULTS,
+                           SETTINGS, SHEET_SIZE, STATS, TOKEN)
+from source.profiler import profiler
+from source.state import StateStore
+from source.storage import MinioClient, SpooledClient, StorageUnavailable
+from source.transformer import ImageTransformer, make_contact_sheet
+from source.utils import choose_photo_size, record_updates
 
-bot = telebot.TeleBot(TOKEN)
-client = MinioClient()
+
+class TeleBot(telebot.TeleBot):
+    """
+    TeleBot which does not lose messages of a batch of updates:
+    pyTelegramBotAPI 4.3.1 pops messages handled by next step
+    handlers from the list while iterating over it, so the message
+    following a handled one skips its own step handler.
+    """
+    def _notify_next_handlers(self, new_messages):
+        handled = set()  # IDs of message objects
+        for message in new_messages:
+            handlers = self.next_step_backend.get_handlers(message.chat.id)
+            if handlers:
+                for handler in handlers:
+                    self._exec_task(
+                        handler["callback"], message,
+                        *handler["args"], **handler["kwargs"]
+                    )
+                handled.add(id(message))
+        # the list is shared with the other handlers
+        new_messages[:] = [
+            message for message in new_messages
+            if id(message) not in handled
+        ]
+
+
+bot = TeleBot(TOKEN)
+client = SpooledClient(MinioClient())
+states = StateStore()
+
+
+def register_step(message, step, *args):
+    """
+    Registers the next step handler of a chat and remembers it
+    in the state store. Step arguments must be small and
+    JSON-serializable (e.g., a blob key or a cursor).
+    """
+    states.set(message.chat.id, step.__name__, args)
+    bot.register_next_step_handler(message, run_step, step.__name__, *args)
+
+
+def run_step(message, step_name: str, *args):
+    """
+    Runs a registered step. The step is forgotten unless
+    it registers the next one.
+    """
+    states.drop(message.chat.id)
+    STEPS[step_name](message, *args)
+
+
+def restore_steps():
+    """
+    Registers again all steps remembered before a restart
+    and deletes blobs which none of them refers to.
+    """
+    steps = states.load()
+    for chat_id, (step_name, args) in steps.items():
+        bot.register_next_step_handler_by_chat_id(
+            chat_id, run_step, step_name, *args
+        )
+    states.prune_blobs(
+        args[0] for step_name, args in steps.values()
+        if step_name == upload_result_step.__name__
+    )
 
 
 @bot.message_handler(commands=["help"])
@@ -31,23 +100,41 @@ def start(message):
     Note that user's buffer of images is flushed each time start
     command is typed.
     """
-    IMAGES[message.from_user.id] = []  # refresh buffer
+    # refresh buffer: photos are kept while it exists
+    IMAGES[message.from_user.id] = IMAGES.default_factory()
     chat_id = message.chat.id
     user_first_name = message.from_user.first_name
     msg = bot.send_message(chat_id, MSG.start.format(user_first_name))
-    bot.register_next_step_handler(msg, process_photo_step)
+    register_step(msg, process_photo_step)
 
 
 def connect_storage(func):
+    @wraps(func)
     def wrapper(message, *args, **kwargs):
         try:
             func(message, *args, **kwargs)
-        except (MaxRetryError, HTTPError):
+        except (MaxRetryError, HTTPError, StorageUnavailable):
             bot.reply_to(message, MSG.storage_exc)
             return
     return wrapper
 
 
+def step_break_handler(func):
+    """
+    Breaks interaction with a user if /restart is typed.
+    """
+    @wraps(func)
+    def wrapper(message, *args, **kwargs):
+        if message.text == '/restart':
+            bot.send_message(message.chat.id, MSG.restart)
+            bot.clear_step_handler_by_chat_id(message.chat.id)
+            states.drop(message.chat.id)
+            CONTENT.pop(message.chat.id, None)
+            return
+        return func(message, *args, **kwargs)
+    return wrapper
+
+
 @bot.message_handler(commands=["download"])
 def download_user_content(message):
     user_id = str(message.from_user.id)
@@ -58,30 +145,93 @@ def download_user_content(message):
 @bot.message_handler(commands=["download_all"])
 def download_all_content(message):
     msg = bot.send_message(message.chat.id, MSG.download_all)
-    bot.register_next_step_handler(msg, _download_all_content)
+    register_step(msg, _download_all_content)
 
 
 @connect_storage
 def _download_all_content(message, user_list: List[str] = []):
+    """
+    Sends contact sheets with numbered thumbnails of available
+    content, so that a user can choose which originals to get.
+    """
     text = message.text
+    chat_id = message.chat.id
     if text != '/all' and not user_list:
         user_list = ("".join(text.split())).split(',')
-    content = client.download_all_content(user_list)
+    keys = CONTENT[chat_id] = client.list_content(user_list)
+    if not keys:
+        bot.send_message(chat_id, MSG.no_content)
+        return
+    for start in range(0, len(keys), SHEET_SIZE):
+        thumbs = client.download_thumbnails(keys[start:start + SHEET_SIZE])
+        bot.send_photo(chat_id, make_contact_sheet(thumbs, start + 1))
+    msg = bot.send_message(chat_id, MSG.choose)
+    register_step(msg, choose_content_step, user_list)
+
+
+def _content_keys(message, user_list: List[str]) -> List[Tuple[str, str]]:
+    """
+    Returns listed content of a chat. Content is listed
+    again only if it was lost (e.g., after a restart).
+    """
+    chat_id = message.chat.id
+    if chat_id not in CONTENT:
+        CONTENT[chat_id] = client.list_content(user_list)
+    return CONTENT[chat_id]
+
+
+@step_break_handler
+@connect_storage
+def choose_content_step(message, user_list: List[str] = []):
+    """
+    Parses numbers of chosen content (or /all)
+    and starts sending originals. Any other answer
+    ends the downloading.
+    """
+    text = message.text or ''
+    keys = _content_keys(message, user_list)
+    if text == '/all':
+        indices = None
+    else:
+        indices = [
+            int(i) for i in "".join(text.split()).split(',')
+            if i.isdecimal() and 0 < int(i) <= len(keys)
+        ]
+    if indices == []:
+        CONTENT.pop(message.chat.id, None)
+        text_handler(message)
+        return
     message.text = '/Y'  # first mock answer
-    send_batch(message, content)
+    send_batch(message, user_list, indices)
 
 
-def send_batch(message, content: List[io.BytesIO] = []):
+@connect_storage
+def send_batch(message,
+               user_list: List[str] = [],
+               indices: Optional[List[int]] = None,
+               cursor: int = 0):
+    """
+    Downloads and sends the next batch of chosen content
+    (all content if ``indices`` is None) starting from ``cursor``.
+    """
+    chat_id = message.chat.id
     if message.text != '/Y':  # answer for question ``More?``
+        CONTENT.pop(chat_id, None)
         return
-    for i, obj in enumerate(content, 1):
+    keys = _content_keys(message, user_list)
+    if indices is None:
+        chosen = keys
+    else:
+        chosen = [keys[i - 1] for i in indices if 0 < i <= len(keys)]
+    batch = chosen[cursor:cursor + BATCH_SIZE]
+    for obj in client.download_content(batch):
         send_content(message, obj)
-        if i % BATCH_SIZE == 0:
-            msg = bot.send_message(message.chat.id, MSG.more)
-            bot.register_next_step_handler(
-                msg, send_batch, content[BATCH_SIZE:]
-            )
-            break
+    cursor += BATCH_SIZE
+    if cursor < len(chosen):
+        msg = bot.send_message(chat_id, MSG.more)
+        register_step(msg, send_batch, user_list, indices, cursor)
+        return
+    CONTENT.pop(chat_id, None)
 
 
 def send_content(message, obj: io.BytesIO, caption=None):
@@ -89,63 +239,106 @@ def send_content(message, obj: io.BytesIO, caption=None):
     bot.send_document(chat_id, obj, caption=caption)
 
 
-@bot.message_handler(content_types=["text"])
-def text_handler(message):
+@bot.message_handler(
+    commands=["profile"], func=lambda m: m.from_user.id in ADMIN_IDS
+)
+def profile(message):
     """
-    Basic text handler. Replies to an unexpected text.
+    Admin command. Samples a given percent of render
+    and storage jobs with a profiler (0 stops it).
     """
-    bot.send_message(message.chat.id, MSG.text)
+    args = message.text.split()[1:]
+    try:
+        percent = float(args[0])
+        if not math.isfinite(percent):
+            raise ValueError(percent)
+    except (IndexError, ValueError):
+        bot.send_message(message.chat.id, MSG.profile_usage)
+        return
+    profiler.enable(percent / 100)
+    bot.send_message(message.chat.id, MSG.profile.format(profiler.rate * 100))
 
 
-def step_break_handler(func):
+@bot.message_handler(
+    commands=["stats"], func=lambda m: m.from_user.id in ADMIN_IDS
+)
+def stats(message):
     """
-    Breaks interaction with a user if /restart is typed.
+    Admin command. Shows counters of downloaded photos.
     """
-    @wraps(func)
-    def wrapper(message, *args, **kwargs):
-        if message.text == '/restart':
-            bot.send_message(message.chat.id, MSG.restart)
-            bot.clear_step_handler_by_chat_id(message.chat.id)
-            return
-        return func(message, *args, **kwargs)
-    return wrapper
+    counters = {
+        key: STATS[key]
+        for key in ['photos', 'photo_bytes', 'photo_bytes_saved']
+    }
+    bot.send_message(message.chat.id, MSG.stats.format(**counters))
+
+
+def toggle_profiling(signum, frame):
+    """
+    Signal handler. Switches profiling on (with a default
+    sampling rate) or off.
+    """
+    if profiler.rate:
+        profiler.disable()
+    else:
+        profiler.enable(PROFILE_SIGNAL_RATE)
+
+
+@bot.message_handler(content_types=["text"])
+def text_handler(message):
+    """
+    Basic text handler. Replies to an unexpected text.
+    """
+    bot.send_message(message.chat.id, MSG.text)
 
 
 def process_photo(message):
     """
-    Adds image bytes to the USERS dictionary.
+    Adds a decoded image to the IMAGES dictionary, so that
+    only a watermark is left to do after the last image.
+    Downloads the smallest photo size which is enough for a GIF.
     """
-    file_id = message.photo[-1].file_id
-    file_info = bot.get_file(file_id)
+    photo = choose_photo_size(message.photo, MAX_FRAME_SIZE)
+    file_info = bot.get_file(photo.file_id)
     file_bytes = bot.download_file(file_info.file_path)
     IMAGES[message.from_user.id].append(file_bytes)
+    STATS.add('photos')
+    STATS.add('photo_bytes', len(file_bytes))
+    largest = message.photo[-1]
+    if largest.file_size and photo.file_size:
+        STATS.add('photo_bytes_saved', largest.file_size - photo.file_size)
 
 
 @bot.message_handler(content_types=['photo'])
 def photo_handler(message):
     """
-    Handler for a photo content type.
+    Handler for a photo content type. During GIF creation
+    a photo which arrives before the next step is registered
+    is kept; otherwise the photo is not kept.
     """
-    process_photo(message)
+    if message.from_user.id in IMAGES:
+        process_photo(message)
+    else:
+        bot.send_message(message.chat.id, MSG.text)
 
 
 @step_break_handler
 def process_photo_step(message):
     """
-    Stores images received from a user as bytes in USERS
-    until /done command is typed.
+    Stores images received from a user as decoded frames
+    in IMAGES until /done command is typed.
     """
     answer = MSG.process_photo
     next_step = process_photo_step
     if message.photo:
-        photo_handler(message)
+        process_photo(message)
         time.sleep(2)
         answer = MSG.process_photo_done
     if (message.text == '/done') and IMAGES[message.from_user.id]:
         next_step = process_text_step
         answer = MSG.process_photo_next
     msg = bot.send_message(message.chat.id, answer)
-    bot.register_next_step_handler(msg, next_step)
+    register_step(msg, next_step)
 
 
 @step_break_handler
@@ -163,7 +356,7 @@ def process_text_step(message):
         answer = MSG.font
         next_step = process_font_type_step
     msg = bot.send_message(message.chat.id, answer)
-    bot.register_next_step_handler(msg, next_step)
+    register_step(msg, next_step)
 
 
 @step_break_handler
@@ -181,7 +374,7 @@ def process_font_type_step(message):
         answer = MSG.size
         next_step = process_font_size_step
     msg = bot.send_message(message.chat.id, answer)
-    bot.register_next_step_handler(msg, next_step)
+    register_step(msg, next_step)
 
 
 @step_break_handler
@@ -199,7 +392,7 @@ def process_font_size_step(message):
         send_result_step(message)
         return
     msg = bot.send_message(message.chat.id, MSG.size)
-    bot.register_next_step_handler(msg, process_font_size_step)
+    register_step(msg, process_font_size_step)
 
 
 @step_break_handler
@@ -211,23 +404,62 @@ def send_result_step(message):
     """
     chat_id = message.chat.id
     user_id = message.from_user.id
-    obj = ImageTransformer(user_id).transform()
+    try:
+        obj = ImageTransformer(user_id).transform()
+    finally:
+        IMAGES.pop(user_id, None)  # free decoded frames
     send_content(message, obj, caption='All done!')
+    RESULTS[chat_id] = obj
+    key = f'{chat_id}_{obj.name}'  # a user may finish in several chats
+    states.put_blob(key, obj)
     msg = bot.send_message(chat_id, MSG.finish)
-    bot.register_next_step_handler(msg, upload_result_step, obj)
+    register_step(msg, upload_result_step, key)
 
 
 @connect_storage
-def upload_result_step(message, obj: io.BytesIO):
-    if message.text in ['/save', '/publish']:
+def upload_result_step(message, key: str):
+    """
+    Uploads the last result to the storage. The result is
+    taken from memory or, after a restart, from a blob by key.
+    """
+    obj = RESULTS.pop(message.chat.id, None)
+    if obj is None:
+        obj = states.get_blob(key)
+        if obj is not None:
+            obj.name = key.partition('_')[2]
+    states.delete_blob(key)
+    if obj is not None and message.text in ['/save', '/publish']:
         is_private = (message.text == '/save') | (obj.name[-3:] != 'GIF')
-        client.upload(message.from_user.id, obj, is_private)
-        bot.send_message(message.chat.id, MSG.saved)
+        if client.upload(message.from_user.id, obj, is_private):
+            bot.send_message(message.chat.id, MSG.saved)
+        else:
+            bot.send_message(message.chat.id, MSG.spooled)
     else:
         text_handler(message)
 
 
+STEPS = {
+    step.__name__: step for step in [
+        process_photo_step,
+        process_text_step,
+        process_font_type_step,
+        process_font_size_step,
+        upload_result_step,
+        _download_all_content,
+        choose_content_step,
+        send_batch,
+    ]
+}
+
+
 if __name__ == '__main__':
-    bot.enable_save_next_step_handlers()
-    bot.load_next_step_handlers()
-    bot.infinity_polling()
+    if RECORD_UPDATES:
+        record_updates(RECORD_UPDATES)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, toggle_profiling)
+    restore_steps()
+    client.start()
+    try:
+        bot.infinity_polling()
+    finally:
+        states.close()
@@ -3,7 +3,7 @@ from collections import defaultdict
 
 from dotenv import load_dotenv
 
-from source.utils import Settings, parse_available_font_types
+from source.utils import Counters, Frames, Settings, parse_available_font_types
 
 load_dotenv()
 
@@ -11,11 +11,44 @@ TOKEN = os.environ.get('TOKEN')
 ADDRESS = os.environ.get('MINIO_API_ADDRESS')
 ACCESS_KEY = os.environ.get('ACCESS_KEY')
 SECRET_KEY = os.environ.get('SECRET_KEY')
+RECORD_UPDATES = os.environ.get('RECORD_UPDATES')  # JSONL path
 
-IMAGES = defaultdict(list)
+# GIF frames are downscaled to fit this box, and the smallest Telegram
+# photo size filling it is downloaded (800 matches Telegram's 'x' size)
+MAX_FRAME_SIDE = int(os.environ.get('MAX_FRAME_SIDE', 800))
+MAX_FRAME_SIZE = (MAX_FRAME_SIDE, MAX_FRAME_SIDE)
+IMAGES = defaultdict(lambda: Frames(MAX_FRAME_SIZE))
+STATS = Counters()  # e.g., downloaded bytes
+RESULTS = dict()  # chat ID --> last result
+CONTENT = dict()  # chat ID --> listed content
 SETTINGS = defaultdict(lambda: Settings())
 BATCH_SIZE = 2
 
+THUMB_PREFIX = 'thumbnails/'
+THUMB_SIZE = (160, 160)
+SHEET_COLUMNS = 5
+SHEET_SIZE = 30  # thumbnails per contact sheet
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', './.profiles')
+PROFILE_SIGNAL_RATE = 0.1  # fraction of jobs sampled after SIGUSR1
+ADMIN_IDS = [
+    int(x) for x in os.environ.get('ADMIN_IDS', '').split(',') if x
+]
+
+STORAGE_CONNECT_TIMEOUT = 3  # seconds
+STORAGE_READ_TIMEOUT = 60  # seconds
+STORAGE_RETRIES = 2
+BREAKER_THRESHOLD = 3  # consecutive storage errors
+BREAKER_RESET_TIMEOUT = 30  # seconds
+SPOOL_DIR = os.environ.get('SPOOL_DIR', './.spool')
+SPOOL_INTERVAL = 10  # seconds between replays
+SPOOL_WORKERS = 4
+SPOOL_MAX_ATTEMPTS = 5  # then an entry is moved to a dead-letter dir
+
+STATE_DIR = os.environ.get('STATE_DIR', './.state')
+STATE_FLUSH_SIZE = 64
+STATE_FLUSH_INTERVAL = 1.0  # seconds
+
 FONT_TYPES = parse_available_font_types()
 FONT_COMMANDS = list(
     map(lambda x: '/' + x[:-4], FONT_TYPES)  # arial.ttf --> /arial
@@ -50,6 +83,11 @@ class MSG:
         "Type IDs of users whom content you'd like to download "\
         "(comma-separated, e.g., 1,2,3,...) or type /all "\
         "to get all available content."
+    no_content = "There is nothing to download yet."
+    choose = \
+        "Type numbers of content you'd like to download "\
+        "(comma-separated, e.g., 1,2,3,...) or type /all "\
+        "to get everything."
     more = "More? (/Y or /N)"
 
     text = "Try to type /start or /help command."
@@ -70,3 +108,13 @@ class MSG:
         "in a publicly available storage or /save for private "\
         "only keeping."
     saved = "I kept it!"
+    spooled = \
+        "Storage is not reachable now, "\
+        "I will keep it as soon as possible."
+
+    profile = "Profiling {:g}% of jobs."
+    profile_usage = "Type /profile with a percent of jobs (0 to stop)."
+    stats = \
+        "Photos: {photos}\n"\
+        "Downloaded: {photo_bytes} bytes\n"\
+        "Saved by choosing smaller sizes: {photo_bytes_saved} bytes"
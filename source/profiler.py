@@ -0,0 +1,88 @@
+import cProfile
+import datetime as dt
+import math
+import random
+import re
+import threading
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Dict, Optional, Union
+
+from source.config import PROFILE_DIR
+
+# Since Python 3.12 only one profiler may be active in a process
+# (and it records all threads), so one job is sampled at a time.
+_profiling = threading.Lock()
+
+
+class Profiler:
+    """
+    Class for on-demand profiling of live jobs: when enabled,
+    a fraction of calls of decorated functions runs under cProfile
+    and their profiles are dumped to a directory with job parameters
+    in file names. When disabled, a decorated call costs one check.
+
+    :ivar path: directory for profiles
+    :ivar rate: fraction of sampled calls (0 means disabled)
+    """
+    def __init__(self, path: Union[str, Path] = PROFILE_DIR):
+        self.path = Path(path)
+        self.rate = 0.0
+
+    def enable(self, rate: float) -> None:
+        """
+        Starts sampling calls.
+
+        :param rate: fraction of sampled calls (from 0 to 1)
+        """
+        if not math.isfinite(rate):
+            rate = 0.0
+        self.rate = min(max(rate, 0.0), 1.0)
+
+    def disable(self) -> None:
+        self.rate = 0.0
+
+    def profile(self, name: str,
+                tags: Optional[Callable[..., Dict]] = None) -> Callable:
+        """
+        Decorator sampling calls of a function.
+
+        :param name: profile name
+        :param tags: function of the call arguments returning
+            job parameters to tag a profile with
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.rate or random.random() >= self.rate:
+                    return func(*args, **kwargs)
+                # other (or nested) jobs run unprofiled meanwhile
+                if not _profiling.acquire(blocking=False):
+                    return func(*args, **kwargs)
+                try:
+                    job = tags(*args, **kwargs) if tags is not None else {}
+                    profile = cProfile.Profile()
+                    try:
+                        profile.enable()
+                    except ValueError:  # another profiling tool is active
+                        return func(*args, **kwargs)
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        profile.disable()
+                        self._dump(profile, name, job)
+                finally:
+                    _profiling.release()
+            return wrapper
+        return decorator
+
+    def _dump(self, profile: cProfile.Profile,
+              name: str, tags: Dict) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        parts = [dt.datetime.now().strftime("%m-%d-%Y-%H-%M-%S-%f"), name]
+        parts += [f'{key}={value}' for key, value in tags.items()]
+        file_name = re.sub(r'[^\w=.-]', '_', '-'.join(parts))
+        profile.dump_stats(str(self.path / f'{file_name}.prof'))
+
+
+profiler = Profiler()
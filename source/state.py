@@ -0,0 +1,168 @@
+import io
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from source.config import STATE_DIR, STATE_FLUSH_INTERVAL, STATE_FLUSH_SIZE
+
+
+class StateStore:
+    """
+    Class for keeping users' conversation steps between restarts.
+    Only a step name and its small JSON-serializable arguments
+    (e.g., a blob key or a cursor) are stored per chat, so a step
+    transition is a dictionary update. Changes are written to SQLite
+    in batches: when enough of them are pending or after a short delay.
+
+    :ivar path: directory with a database and blobs
+    :ivar flush_size: number of pending changes forcing a flush
+    :ivar flush_interval: max delay (in seconds) before a flush
+    """
+    def __init__(self,
+                 path: Union[str, Path] = STATE_DIR,
+                 flush_size: int = STATE_FLUSH_SIZE,
+                 flush_interval: float = STATE_FLUSH_INTERVAL):
+        self.path = Path(path)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._conn = None
+        self._pending = dict()  # chat ID --> (step, args) or None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(
+                str(self.path / 'steps.db'), check_same_thread=False
+            )
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS steps ('
+                'chat_id INTEGER PRIMARY KEY, step TEXT, args TEXT)'
+            )
+        return self._conn
+
+    def set(self, chat_id: int, step: str, args: List[Any] = []) -> None:
+        """
+        Remembers the next step of a chat.
+
+        :param chat_id: chat ID in Telegram
+        :param step: step (handler) name
+        :param args: small JSON-serializable step arguments
+        """
+        self._update(chat_id, (step, json.dumps(list(args))))
+
+    def drop(self, chat_id: int) -> None:
+        """
+        Forgets the next step of a chat.
+
+        :param chat_id: chat ID in Telegram
+        """
+        self._update(chat_id, None)
+
+    def _update(self, chat_id: int,
+                value: Optional[Tuple[str, str]]) -> None:
+        with self._lock:
+            self._pending[chat_id] = value
+            if len(self._pending) >= self.flush_size:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(
+                    self.flush_interval, self.flush
+                )
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        """
+        Writes all pending changes in one transaction.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, dict()
+        with self.conn:
+            self.conn.executemany(
+                'DELETE FROM steps WHERE chat_id = ?',
+                [(chat_id,) for chat_id, v in pending.items() if v is None]
+            )
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO steps VALUES (?, ?, ?)',
+                [(chat_id, *v) for chat_id, v in pending.items() if v]
+            )
+
+    def load(self) -> Dict[int, Tuple[str, List[Any]]]:
+        """
+        Reads all remembered steps.
+
+        :return: step name and its arguments by chat ID
+        """
+        self.flush()
+        rows = self.conn.execute('SELECT chat_id, step, args FROM steps')
+        return {
+            chat_id: (step, json.loads(args))
+            for chat_id, step, args in rows
+        }
+
+    def put_blob(self, key: str, obj: io.BytesIO) -> None:
+        """
+        Keeps a step payload on disk, so that the step
+        can refer to it by a key only.
+
+        :param key: blob key
+        :param obj: payload
+        """
+        blobs = self.path / 'blobs'
+        blobs.mkdir(parents=True, exist_ok=True)
+        (blobs / key).write_bytes(obj.getvalue())
+
+    def get_blob(self, key: str) -> Optional[io.BytesIO]:
+        """
+        Gets a step payload by a key.
+
+        :param key: blob key
+        :return: payload (if exists)
+        """
+        blob = self.path / 'blobs' / key
+        if not blob.is_file():
+            return
+        obj = io.BytesIO(blob.read_bytes())
+        obj.name = key
+        return obj
+
+    def delete_blob(self, key: str) -> None:
+        (self.path / 'blobs' / key).unlink(missing_ok=True)
+
+    def prune_blobs(self, keep: Iterable[str]) -> int:
+        """
+        Deletes blobs which no step refers to anymore
+        (e.g., left by a step forgotten before a restart).
+
+        :param keep: keys of blobs in use
+        :return: number of deleted blobs
+        """
+        blobs = self.path / 'blobs'
+        if not blobs.is_dir():
+            return 0
+        keep = set(keep)
+        stale = [blob for blob in blobs.iterdir() if blob.name not in keep]
+        for blob in stale:
+            blob.unlink(missing_ok=True)
+        return len(stale)
+
+    def close(self) -> None:
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
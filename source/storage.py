@@ -1,10 +1,41 @@
 import datetime as dt
 import io
-from typing import List, Union
+import json
+import shutil
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
 
+import urllib3
 from minio import Minio
+from minio.error import S3Error
 
-from source.config import ACCESS_KEY, ADDRESS, SECRET_KEY
+from source.config import (ACCESS_KEY, ADDRESS, BREAKER_RESET_TIMEOUT,
+                           BREAKER_THRESHOLD, SECRET_KEY, SPOOL_DIR,
+                           SPOOL_INTERVAL, SPOOL_MAX_ATTEMPTS, SPOOL_WORKERS,
+                           STORAGE_CONNECT_TIMEOUT, STORAGE_READ_TIMEOUT,
+                           STORAGE_RETRIES, THUMB_PREFIX)
+from source.profiler import profiler
+from source.transformer import make_thumbnail
+
+# errors meaning that the storage is not reachable
+STORAGE_ERRORS = (
+    urllib3.exceptions.MaxRetryError,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.TimeoutError,
+    socket.timeout,
+    ConnectionError,
+)
+
+
+class StorageUnavailable(Exception):
+    """
+    Raised instead of calling the storage while it is unhealthy.
+    """
 
 
 class MinioClient:
@@ -12,24 +43,42 @@ class MinioClient:
     Class for storage management:
     uploading (PUT) or downloading (GET) objects.
     """
-    def __init__(self):
+    def __init__(self,
+                 address: str = ADDRESS,
+                 access_key: str = ACCESS_KEY,
+                 secret_key: str = SECRET_KEY):
         self.client = Minio(
-            ADDRESS,
-            access_key=ACCESS_KEY,
-            secret_key=SECRET_KEY,
+            address,
+            access_key=access_key,
+            secret_key=secret_key,
             secure=False,
+            http_client=urllib3.PoolManager(
+                timeout=urllib3.Timeout(
+                    connect=STORAGE_CONNECT_TIMEOUT,
+                    read=STORAGE_READ_TIMEOUT,
+                ),
+                retries=urllib3.Retry(
+                    total=STORAGE_RETRIES, backoff_factor=0.2,
+                    status_forcelist=[500, 502, 503, 504],
+                ),
+            ),
         )
 
+    @profiler.profile('upload', lambda self, user_id, obj, *args, **kwargs: {
+        'object': obj.name, 'bytes': obj.getbuffer().nbytes,
+    })
     def upload(self,
                user_id: Union[int, str],
                obj: io.BytesIO,
-               private: bool = False) -> None:
+               private: bool = False,
+               created: Optional[dt.datetime] = None) -> None:
         """
-        Put an object to the storage.
+        Put an object to the storage together with its thumbnail.
 
         :param user_id: user ID in Telegram
         :param obj: image object
         :param private: whether to store in a private section
+        :param created: creation time for an object name (default: now)
         """
         access = 'private' if private else 'public'
         bucket_name = '-'.join([str(user_id), access])
@@ -37,27 +86,112 @@ class MinioClient:
             self.client.make_bucket(bucket_name)
         obj.seek(0)
         obj_name = '-'.join([
-            dt.datetime.now().strftime("%m-%d-%Y-%H-%M-%S"), obj.name
+            (created or dt.datetime.now()).strftime("%m-%d-%Y-%H-%M-%S"),
+            obj.name
         ])
         length = obj.getbuffer().nbytes
         self.client.put_object(bucket_name, obj_name, obj, length=length)
+        self._put_thumbnail(bucket_name, obj_name, obj)
+
+    def _put_thumbnail(self, bucket_name: str, obj_name: str,
+                       obj: io.BytesIO) -> io.BytesIO:
+        thumb = make_thumbnail(obj)
+        length = thumb.getbuffer().nbytes
+        self.client.put_object(
+            bucket_name, THUMB_PREFIX + obj_name, thumb, length=length
+        )
+        thumb.seek(0)
+        return thumb
+
+    def _get_object(self, bucket_name: str, obj_name: str) -> io.BytesIO:
+        response = self.client.get_object(bucket_name, obj_name)
+        # get image bytes
+        stream = io.BytesIO()
+        stream.name = obj_name
+        stream.write(response.data)
+        stream.seek(0)
+        # disconnect from storage
+        response.close()
+        response.release_conn()
+        return stream
+
+    def _get_thumbnail(self, bucket_name: str, obj_name: str) -> io.BytesIO:
+        try:
+            return self._get_object(bucket_name, THUMB_PREFIX + obj_name)
+        except S3Error as e:
+            if e.code != 'NoSuchKey':
+                raise
+            # not created yet
+            original = self._get_object(bucket_name, obj_name)
+            return self._put_thumbnail(bucket_name, obj_name, original)
+
+    def _list_bucket_content(self, bucket_name: str) -> List[str]:
+        return [
+            obj.object_name for obj in self.client.list_objects(bucket_name)
+            if not obj.object_name.startswith(THUMB_PREFIX)
+        ]
 
     def _download_bucket_content(self, bucket_name: str) -> List[io.BytesIO]:
-        content = []
-        objects = self.client.list_objects(bucket_name)
-        for obj in objects:
-            obj_name = obj.object_name
-            response = self.client.get_object(bucket_name, obj_name)
-            # get image bytes
-            stream = io.BytesIO()
-            stream.name = obj_name
-            stream.write(response.data)
-            stream.seek(0)
-            content.append(stream)
-            # disconnect from storage
-            response.close()
-            response.release_conn()
-        return content
+        return [
+            self._get_object(bucket_name, obj_name)
+            for obj_name in self._list_bucket_content(bucket_name)
+        ]
+
+    def _public_buckets(self, user_id_list: List[str] = []) -> List[str]:
+        all_buckets = self.client.list_buckets()
+        user_buckets = list(map(lambda x: x + '-public', user_id_list))
+        if user_buckets:
+            return [
+                bucket.name for bucket in all_buckets
+                if bucket.name in user_buckets
+            ]
+        return [
+            bucket.name for bucket in all_buckets
+            if '-public' in bucket.name
+        ]
+
+    @profiler.profile('list_content')
+    def list_content(
+            self, user_id_list: List[str] = []) -> List[Tuple[str, str]]:
+        """
+        List all users' (or specific list of users) content
+        without downloading it.
+
+        :param user_id_list: IDs of users
+        :return: bucket and object names (only public)
+        """
+        return [
+            (bucket, obj_name)
+            for bucket in self._public_buckets(user_id_list)
+            for obj_name in self._list_bucket_content(bucket)
+        ]
+
+    @profiler.profile('download_content', lambda self, keys: {
+        'objects': len(keys),
+    })
+    def download_content(
+            self, keys: List[Tuple[str, str]]) -> List[io.BytesIO]:
+        """
+        Get selected objects.
+
+        :param keys: bucket and object names
+        :return: objects
+        """
+        return [self._get_object(*key) for key in keys]
+
+    @profiler.profile('download_thumbnails', lambda self, keys: {
+        'objects': len(keys),
+    })
+    def download_thumbnails(
+            self, keys: List[Tuple[str, str]]) -> List[io.BytesIO]:
+        """
+        Get thumbnails of selected objects. Missing thumbnails
+        are created on the fly.
+
+        :param keys: bucket and object names
+        :return: thumbnails
+        """
+        return [self._get_thumbnail(*key) for key in keys]
 
     def download_all_content(
             self, user_id_list: List[str] = []) -> List[io.BytesIO]:
@@ -68,24 +202,249 @@ class MinioClient:
         :return: users' content (only public)
         """
         all_content = []
-        all_buckets = self.client.list_buckets()
-        user_buckets = list(map(lambda x: x + '-public', user_id_list))
-        if user_buckets:
-            public_buckets = [
-                bucket.name for bucket in all_buckets
-                if bucket.name in user_buckets
-            ]
-        else:
-            public_buckets = [
-                bucket.name for bucket in all_buckets
-                if '-public' in bucket.name
-            ]
-        for bucket in public_buckets:
+        for bucket in self._public_buckets(user_id_list):
             all_content.extend(self._download_bucket_content(bucket))
         return all_content
 
+    def backfill_thumbnails(self) -> int:
+        """
+        Create missing thumbnails for all stored objects.
+
+        :return: number of created thumbnails
+        """
+        created = 0
+        for bucket in self.client.list_buckets():
+            objects = self.client.list_objects(
+                bucket.name, prefix=THUMB_PREFIX
+            )
+            thumbs = {obj.object_name for obj in objects}
+            for obj_name in self._list_bucket_content(bucket.name):
+                if THUMB_PREFIX + obj_name in thumbs:
+                    continue
+                original = self._get_object(bucket.name, obj_name)
+                self._put_thumbnail(bucket.name, obj_name, original)
+                created += 1
+        return created
+
+
+class CircuitBreaker:
+    """
+    Class for failing fast while the storage is unhealthy:
+    after ``threshold`` consecutive storage errors the circuit opens
+    and calls raise StorageUnavailable without touching the storage.
+    After ``reset_timeout`` seconds one trial call is let through;
+    its success closes the circuit.
+
+    :ivar threshold: number of consecutive errors opening the circuit
+    :ivar reset_timeout: seconds before a trial call
+    """
+    def __init__(self,
+                 threshold: int = BREAKER_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def _allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.opened_at = time.monotonic()  # one trial call
+                return True
+            return False
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls a storage function through the circuit.
+        """
+        if not self._allow():
+            raise StorageUnavailable('storage circuit is open')
+        try:
+            result = func(*args, **kwargs)
+        except STORAGE_ERRORS:
+            with self._lock:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+            raise
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+        return result
+
+
+class SpooledClient:
+    """
+    Storage layer around MinioClient: all calls go through
+    a circuit breaker, and uploads which cannot reach the storage
+    are written to a local spool. A background replayer uploads
+    spooled objects with bounded concurrency once the storage recovers.
+
+    :ivar client: storage client
+    :ivar breaker: circuit breaker
+    :ivar path: spool directory
+    """
+    def __init__(self,
+                 client: MinioClient,
+                 path: Union[str, Path] = SPOOL_DIR,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.client = client
+        self.path = Path(path)
+        self.breaker = breaker or CircuitBreaker()
+        self._wakeup = threading.Event()
+        self._replay_lock = threading.Lock()
+
+    def upload(self,
+               user_id: Union[int, str],
+               obj: io.BytesIO,
+               private: bool = False) -> bool:
+        """
+        Put an object to the storage or, if it is not
+        reachable, to the spool.
+
+        :param user_id: user ID in Telegram
+        :param obj: image object
+        :param private: whether to store in a private section
+        :return: whether the object was stored right away
+        """
+        # a replay keeps the object name of a partly failed attempt
+        created = dt.datetime.now()
+        try:
+            self.breaker.call(
+                self.client.upload, user_id, obj, private, created
+            )
+            return True
+        except STORAGE_ERRORS + (StorageUnavailable,):
+            self._spool(user_id, obj, private, created)
+            return False
+
+    def _spool(self, user_id: Union[int, str], obj: io.BytesIO,
+               private: bool, created: dt.datetime) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        key = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+        (self.path / f'{key}.data').write_bytes(obj.getvalue())
+        meta = {
+            'user_id': user_id, 'private': private, 'name': obj.name,
+            'created': created.isoformat(), 'attempts': 0,
+        }
+        self._write_meta(self.path / f'{key}.json', meta)
+        self._wakeup.set()
+
+    @staticmethod
+    def _write_meta(entry: Path, meta: dict) -> None:
+        # the entry becomes visible to the replayer after renaming
+        tmp = entry.with_suffix('.tmp')
+        tmp.write_text(json.dumps(meta))
+        tmp.rename(entry)
+
+    def _dead_letter(self, entry: Path) -> None:
+        dead = self.path / 'dead'
+        dead.mkdir(exist_ok=True)
+        for path in [entry, entry.with_suffix('.data')]:
+            if path.exists():
+                shutil.move(str(path), str(dead / path.name))
+
+    def spooled(self) -> List[Path]:
+        """
+        :return: spooled entries (oldest first)
+        """
+        if not self.path.is_dir():
+            return []
+        return sorted(self.path.glob('*.json'))
+
+    def _flush_entry(self, entry: Path) -> None:
+        """
+        Uploads a spooled entry. Entries failing for other reasons
+        than an unreachable storage are moved to the ``dead``
+        directory after SPOOL_MAX_ATTEMPTS attempts (at once
+        if they cannot be read).
+        """
+        data = entry.with_suffix('.data')
+        try:
+            meta = json.loads(entry.read_text())
+            obj = io.BytesIO(data.read_bytes())
+            obj.name = meta['name']
+            created = dt.datetime.fromisoformat(meta['created'])
+        except (OSError, ValueError, KeyError):
+            self._dead_letter(entry)
+            raise
+        try:
+            self.breaker.call(
+                self.client.upload, meta['user_id'], obj, meta['private'],
+                created,
+            )
+        except STORAGE_ERRORS + (StorageUnavailable,):
+            raise
+        except Exception:
+            meta['attempts'] = meta.get('attempts', 0) + 1
+            if meta['attempts'] >= SPOOL_MAX_ATTEMPTS:
+                self._dead_letter(entry)
+            else:
+                self._write_meta(entry, meta)
+            raise
+        entry.unlink()
+        data.unlink()
+
+    def replay(self) -> int:
+        """
+        Uploads spooled objects (at most SPOOL_WORKERS at once)
+        until the storage fails.
+
+        :return: number of uploaded objects
+        """
+        with self._replay_lock:
+            entries = self.spooled()
+            if not entries:
+                return 0
+            with ThreadPoolExecutor(max_workers=SPOOL_WORKERS) as pool:
+                futures = [
+                    pool.submit(self._flush_entry, entry)
+                    for entry in entries
+                ]
+            return sum(
+                future.exception() is None for future in futures
+            )
+
+    def _replay_forever(self) -> None:
+        while True:
+            self._wakeup.wait(SPOOL_INTERVAL)
+            self._wakeup.clear()
+            self.replay()
+
+    def start(self) -> None:
+        """
+        Starts the background replayer.
+        """
+        threading.Thread(target=self._replay_forever, daemon=True).start()
+
+    def list_content(self, *args, **kwargs):
+        return self.breaker.call(self.client.list_content, *args, **kwargs)
+
+    def download_content(self, *args, **kwargs):
+        return self.breaker.call(
+            self.client.download_content, *args, **kwargs
+        )
+
+    def download_thumbnails(self, *args, **kwargs):
+        return self.breaker.call(
+            self.client.download_thumbnails, *args, **kwargs
+        )
+
+    def download_all_content(self, *args, **kwargs):
+        return self.breaker.call(
+            self.client.download_all_content, *args, **kwargs
+        )
+
 
 if __name__ == '__main__':
     client = MinioClient()
     buckets = client.client.list_buckets()
     print(buckets)
+    print('Thumbnails created:', client.backfill_thumbnails())
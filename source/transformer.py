@@ -1,9 +1,10 @@
 import io
-from typing import Tuple
+from typing import List, Tuple
 
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+from PIL import Image, ImageDraw, ImageFont
 
-from source.config import IMAGES, SETTINGS
+from source.config import IMAGES, SETTINGS, SHEET_COLUMNS, THUMB_SIZE
+from source.profiler import profiler
 
 
 class ImageTransformer:
@@ -17,7 +18,7 @@ class ImageTransformer:
     :ivar text: message text
     :ivar font_family: font family name (e.g., arial)
     :ivar img_fraction: ratio of font and image sizes
-    :ivar images: list of images as bytes
+    :ivar images: list of decoded images
     :ivar format: file format for after transforming
     :ivar width: resulting image width
     :ivar height: resulting image height
@@ -27,29 +28,16 @@ class ImageTransformer:
         self.text = SETTINGS[user_id].text
         self.font_family = SETTINGS[user_id].font_family
         self.img_fraction = SETTINGS[user_id].font_size
-        self.images = [Image.open(io.BytesIO(img)) for img in IMAGES[user_id]]
+        frames = IMAGES[user_id]
+        self.images = list(frames)
         self.format = 'JPEG' if len(self.images) <= 1 else 'GIF'
-        self.width, self.height = self._define_gif_size()
-
-    def _define_gif_size(self) -> Tuple[int, int]:
-        """
-        Determines an optimal GIF size in case
-        of images having different sizes.
-
-        :return: optimal width and height
-        """
-        max_width, max_height = -1, -1
-        for image in self.images:
-            width, height = image.size
-            if width > max_width:
-                max_width = width
-            if height > max_height:
-                max_height = height
-        return max_width, max_height
+        self.width, self.height = frames.width, frames.height
+        self._watermarks = dict()  # image width --> watermark
 
     def _add_borders(self, img: Image.Image) -> Image.Image:
         """
-        Expands an image size in accordance to an optimal one.
+        Pastes an image onto a white canvas of an optimal size.
+        This is the only new full-size image per frame.
 
         :param img: image to process
         :return: expanded image
@@ -57,38 +45,68 @@ class ImageTransformer:
         width, height = img.size
         w_border = (self.width - width) // 2
         h_border = (self.height - height) // 2
-        expand = ImageOps.expand(
-            img, (w_border, h_border, w_border, h_border), fill='white'
+        expand = Image.new(
+            'RGB', (width + 2 * w_border, height + 2 * h_border), 'white'
         )
+        expand.paste(img, (w_border, h_border))
         return expand
 
-    def _add_watermark(self, img: Image.Image,
-                       font_size: int = 1) -> Image.Image:
+    def _fit_font(self, width: int) -> ImageFont.FreeTypeFont:
         """
-        Adds a watermark to an image.
+        Finds the smallest font with a text width not less
+        than ``img_fraction`` of an image width. The search starts
+        from an estimate instead of size 1.
 
-        :param img: image to process
-        :param font_size: initial font size
-        :return: image with a watermark
+        :param width: image width
+        :return: font
         """
-        txt = Image.new("RGBA", img.size, (255, 255, 255, 0))
-        draw = ImageDraw.Draw(txt)
-        font = ImageFont.truetype(
-            f"fonts/{self.font_family}.ttf", font_size
-        )
-        while font.getsize(self.text)[0] < self.img_fraction * img.size[0]:
+        path = f"fonts/{self.font_family}.ttf"
+        target = self.img_fraction * width
+
+        def text_width(size: int) -> int:
+            return ImageFont.truetype(path, size).getsize(self.text)[0]
+
+        font_size = max(1, int(target * 100 / max(1, text_width(100))))
+        while font_size > 1 and text_width(font_size - 1) >= target:
+            font_size -= 1
+        while text_width(font_size) < target:
             font_size += 1
-            font = ImageFont.truetype(
-                f"fonts/{self.font_family}.ttf", font_size
+        return ImageFont.truetype(path, font_size)
+
+    def _get_watermark(self,
+                       width: int) -> Tuple[Image.Image, Tuple[int, int]]:
+        """
+        Renders a watermark for images of a given width (once
+        per job): an RGBA layer covering the text box only.
+
+        :param width: image width
+        :return: watermark layer and its position
+        """
+        if width not in self._watermarks:
+            font = self._fit_font(width)
+            w_text, h_text = font.getsize(self.text)
+            x, y = (self.width - w_text) // 2, (self.height - h_text) // 2
+            left, top, right, bottom = font.getbbox(self.text)
+            txt = Image.new(
+                "RGBA", (right - left, bottom - top), (255, 255, 255, 0)
             )
-        w_text, h_text = draw.textsize(self.text, font=font)
-        draw.text((
-            (self.width - w_text) // 2,
-            (self.height - h_text) // 2),
-            self.text, font=font, fill=(0, 0, 0, 128)
-        )
-        out = Image.alpha_composite(img.convert('RGBA'), txt)
-        return out.convert('RGB')
+            draw = ImageDraw.Draw(txt)
+            draw.text(
+                (-left, -top), self.text, font=font, fill=(0, 0, 0, 128)
+            )
+            self._watermarks[width] = (txt, (x + left, y + top))
+        return self._watermarks[width]
+
+    def _add_watermark(self, img: Image.Image) -> Image.Image:
+        """
+        Blends a watermark into an RGB image in place.
+
+        :param img: image to process
+        :return: image with a watermark
+        """
+        txt, position = self._get_watermark(img.size[0])
+        img.paste(txt, position, mask=txt)
+        return img
 
     def _process_image(self, img: Image.Image) -> Image.Image:
         """
@@ -102,6 +120,13 @@ class ImageTransformer:
         watermark = self._add_watermark(expand)
         return watermark
 
+    @profiler.profile('transform', lambda self: {
+        'frames': len(self.images),
+        'canvas': f'{self.width}x{self.height}',
+        'text': len(self.text),
+        'font': self.font_family,
+        'size': self.img_fraction,
+    })
     def transform(self) -> io.BytesIO:
         """
         Applies necessary transformation steps to get
@@ -124,3 +149,58 @@ class ImageTransformer:
             )
         new_image_bytes.seek(0)
         return new_image_bytes
+
+
+def make_thumbnail(obj: io.BytesIO) -> io.BytesIO:
+    """
+    Makes a small JPEG preview from the first frame of an image.
+
+    :param obj: image object
+    :return: thumbnail object
+    """
+    img = Image.open(io.BytesIO(obj.getvalue()))
+    img.draft('RGB', THUMB_SIZE)  # cheap JPEG downscaling on decode
+    img = img.convert('RGB')
+    img.thumbnail(THUMB_SIZE)
+    thumb = io.BytesIO()
+    thumb.name = 'thumbnail.JPEG'
+    img.save(thumb, format='JPEG')
+    thumb.seek(0)
+    return thumb
+
+
+def make_contact_sheet(thumbs: List[io.BytesIO],
+                       start: int = 1) -> io.BytesIO:
+    """
+    Tiles thumbnails into one image and labels each
+    of them with an index number.
+
+    :param thumbs: thumbnail objects
+    :param start: index of the first thumbnail
+    :return: contact sheet object
+    """
+    columns = min(SHEET_COLUMNS, len(thumbs))
+    rows = -(-len(thumbs) // columns)
+    cell_width, cell_height = THUMB_SIZE
+    sheet = Image.new(
+        'RGB', (columns * cell_width, rows * cell_height), 'white'
+    )
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.truetype("fonts/arial.ttf", cell_height // 8)
+    for i, thumb in enumerate(thumbs):
+        img = Image.open(thumb)
+        x = (i % columns) * cell_width
+        y = (i // columns) * cell_height
+        sheet.paste(img, (
+            x + (cell_width - img.width) // 2,
+            y + (cell_height - img.height) // 2,
+        ))
+        draw.text(
+            (x + 4, y + 2), str(start + i), font=font,
+            fill='white', stroke_width=2, stroke_fill='black'
+        )
+    sheet_bytes = io.BytesIO()
+    sheet_bytes.name = 'contents.JPEG'
+    sheet.save(sheet_bytes, format='JPEG')
+    sheet_bytes.seek(0)
+    return sheet_bytes
@@ -1,10 +1,92 @@
+import io
+import json
+import threading
+from collections import defaultdict
 from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+from PIL import Image
+from telebot import apihelper, types
 
 
 class Settings:
     __slots__ = ('text', 'font_family', 'font_size')
 
 
+class Frames:
+    """
+    Frames of a user's GIF: each image is decoded, downscaled
+    (if larger than ``max_size``) and converted to RGB on arrival,
+    and the optimal GIF size (max width and height) is updated.
+
+    :ivar images: decoded RGB images
+    :ivar width: optimal width
+    :ivar height: optimal height
+    """
+    __slots__ = ('images', 'width', 'height', 'max_size')
+
+    def __init__(self, max_size: Tuple[int, int]):
+        self.images = []
+        self.width, self.height = -1, -1
+        self.max_size = max_size
+
+    def append(self, img_bytes: bytes) -> None:
+        img = Image.open(io.BytesIO(img_bytes))
+        img.draft('RGB', self.max_size)  # cheap JPEG downscaling
+        img = img.convert('RGB')
+        img.thumbnail(self.max_size)
+        self.images.append(img)
+        self.width = max(self.width, img.width)
+        self.height = max(self.height, img.height)
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def __iter__(self) -> Iterator[Image.Image]:
+        return iter(self.images)
+
+
+class Counters:
+    """
+    Counters updated from the bot's worker threads
+    (e.g., downloaded bytes).
+    """
+    __slots__ = ('_values', '_lock')
+
+    def __init__(self):
+        self._values = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, key: str, value: int = 1) -> None:
+        with self._lock:
+            self._values[key] += value
+
+    def __getitem__(self, key: str) -> int:
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._values)
+
+
+def choose_photo_size(photo: List[types.PhotoSize],
+                      max_size: Tuple[int, int]) -> types.PhotoSize:
+    """
+    Chooses the smallest photo size which still fills ``max_size``
+    (on one side at least), so that all frames are downscaled
+    to the same box. If no size is large enough, the largest is chosen.
+    """
+    max_width, max_height = max_size
+    large = [
+        size for size in photo
+        if size.width >= max_width or size.height >= max_height
+    ]
+    if large:
+        return min(large, key=lambda size: size.width * size.height)
+    return max(photo, key=lambda size: size.width * size.height)
+
+
 def parse_available_font_types():
     path = Path(__file__).parents[1] / 'fonts'
     files = [
@@ -12,3 +94,20 @@ def parse_available_font_types():
         if x.is_file()
     ]
     return files
+
+
+def record_updates(path: str):
+    """
+    Appends every update received from Telegram to a JSONL file
+    (e.g., to replay it with ``tests.load.harness``).
+    """
+    get_updates = apihelper.get_updates
+
+    def wrapper(*args, **kwargs):
+        updates = get_updates(*args, **kwargs)
+        with open(path, 'a') as f:
+            for update in updates:
+                f.write(json.dumps(update) + '\n')
+        return updates
+
+    apihelper.get_updates = wrapper
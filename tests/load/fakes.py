@@ -0,0 +1,277 @@
+"""
+In-process fakes of the Telegram Bot API and of an S3 (MinIO) endpoint.
+Both keep everything in memory and answer just enough of each API
+for the bot to run end to end.
+"""
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs, quote_plus, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+IMAGES_DIR = Path(__file__).parents[1] / 'test_images'
+S3_NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def _send(self, status: int, body: bytes = b'',
+              content_type: str = 'application/xml') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+class _FakeServer:
+    handler = _Handler
+
+    def __init__(self):
+        server = self
+
+        class Handler(self.handler):
+            fake = server
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True
+        )
+
+    @property
+    def address(self) -> str:
+        host, port = self.httpd.server_address
+        return f'{host}:{port}'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _TelegramHandler(_Handler):
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        url = urlsplit(self.path)
+        match = re.match(r'/file/bot[^/]+/(.+)', url.path)
+        if match:
+            self._send(200, self.fake.file_bytes(match.group(1)),
+                       'application/octet-stream')
+            return
+        method = url.path.rsplit('/', 1)[-1]
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self._body()  # uploaded files are not kept
+        result = self.fake.call(method, params)
+        body = json.dumps({'ok': True, 'result': result}).encode()
+        self._send(200, body, 'application/json')
+
+
+class FakeTelegram(_FakeServer):
+    """
+    Fake Bot API server: delivers queued updates via getUpdates
+    and reports every message sent by the bot to ``on_reply``.
+
+    :ivar on_reply: callback taking a chat ID and an API method name
+    """
+    handler = _TelegramHandler
+    replies = ('sendMessage', 'sendDocument', 'sendPhoto')
+
+    def __init__(self, on_reply: Callable[[int, str], None] = None):
+        super().__init__()
+        self.on_reply = on_reply
+        self._updates = []
+        self._update_id = 0
+        self._message_id = 0
+        self._cond = threading.Condition()
+
+    @property
+    def api_url(self) -> str:
+        return f'http://{self.address}/bot{{0}}/{{1}}'
+
+    @property
+    def file_url(self) -> str:
+        return f'http://{self.address}/file/bot{{0}}/{{1}}'
+
+    def push(self, update: Dict) -> int:
+        """
+        Queues an update (its ID is replaced by the next one).
+
+        :return: update ID
+        """
+        with self._cond:
+            self._update_id += 1
+            self._updates.append(dict(update, update_id=self._update_id))
+            self._cond.notify_all()
+            return self._update_id
+
+    @staticmethod
+    def file_bytes(file_path: str) -> bytes:
+        name = Path(file_path).name
+        if not (IMAGES_DIR / name).is_file():
+            name = '1.jpg'
+        return (IMAGES_DIR / name).read_bytes()
+
+    def call(self, method: str, params: Dict[str, str]):
+        if method == 'getUpdates':
+            return self._get_updates(
+                int(params.get('offset', 0)), float(params.get('timeout', 0))
+            )
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bot'}
+        if method == 'getFile':
+            file_id = params['file_id']
+            return {
+                'file_id': file_id, 'file_unique_id': file_id,
+                'file_size': len(self.file_bytes(file_id)),
+                'file_path': f'photos/{file_id}',
+            }
+        chat_id = int(params.get('chat_id', 0))
+        with self._cond:
+            self._message_id += 1
+            message_id = self._message_id
+        if method in self.replies and self.on_reply is not None:
+            self.on_reply(chat_id, method)
+        return {
+            'message_id': message_id, 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', ''),
+        }
+
+    def _get_updates(self, offset: int, timeout: float) -> List[Dict]:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._updates = [
+                u for u in self._updates if u['update_id'] >= offset
+            ]
+            while not self._updates:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            return self._updates[:100]
+
+
+class _S3Handler(_Handler):
+    def _split(self):
+        url = urlsplit(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        query = {k: v[0] for k, v in
+                 parse_qs(url.query, keep_blank_values=True).items()}
+        return unquote(bucket), unquote(key), query
+
+    def _error(self, status: int, code: str):
+        body = f'<Error><Code>{code}</Code><Message>{code}</Message></Error>'
+        self._send(status, body.encode())
+
+    def do_HEAD(self):
+        bucket, key, _ = self._split()
+        buckets = self.fake.buckets
+        if bucket not in buckets or (key and key not in buckets[bucket]):
+            self._send(404)
+        else:
+            self._send(200)
+
+    def do_PUT(self):
+        bucket, key, _ = self._split()
+        body = self._body()
+        if not key:
+            self.fake.buckets.setdefault(bucket, dict())
+        elif bucket not in self.fake.buckets:
+            return self._error(404, 'NoSuchBucket')
+        else:
+            self.fake.buckets[bucket][key] = body
+        self.send_response(200)
+        self.send_header('ETag', '"0"')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        bucket, key, query = self._split()
+        buckets = self.fake.buckets
+        if not bucket:
+            return self._send(200, self.fake.list_buckets_xml())
+        if bucket not in buckets:
+            return self._error(404, 'NoSuchBucket')
+        if 'location' in query:
+            return self._send(
+                200, f'<LocationConstraint xmlns="{S3_NS}"/>'.encode()
+            )
+        if not key:
+            return self._send(200, self.fake.list_objects_xml(
+                bucket, query.get('prefix', ''), query.get('delimiter', '')
+            ))
+        if key not in buckets[bucket]:
+            return self._error(404, 'NoSuchKey')
+        self._send(200, buckets[bucket][key], 'application/octet-stream')
+
+
+class FakeS3(_FakeServer):
+    """
+    Fake S3 endpoint keeping buckets in memory. Requests
+    are not authenticated and multipart uploads are not supported.
+    """
+    handler = _S3Handler
+    date = '2022-01-01T00:00:00.000Z'
+
+    def __init__(self):
+        super().__init__()
+        self.buckets = dict()  # bucket --> object name --> bytes
+
+    def list_buckets_xml(self) -> bytes:
+        buckets = ''.join(
+            f'<Bucket><Name>{escape(name)}</Name>'
+            f'<CreationDate>{self.date}</CreationDate></Bucket>'
+            for name in sorted(self.buckets)
+        )
+        return (
+            f'<ListAllMyBucketsResult xmlns="{S3_NS}">'
+            f'<Buckets>{buckets}</Buckets></ListAllMyBucketsResult>'
+        ).encode()
+
+    def list_objects_xml(self, bucket: str, prefix: str,
+                         delimiter: Optional[str]) -> bytes:
+        contents, prefixes = [], set()
+        for key, data in sorted(self.buckets[bucket].items()):
+            if not key.startswith(prefix):
+                continue
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                prefixes.add(prefix + rest.split(delimiter)[0] + delimiter)
+                continue
+            contents.append(
+                f'<Contents><Key>{quote_plus(key)}</Key>'
+                f'<LastModified>{self.date}</LastModified>'
+                f'<ETag>"0"</ETag><Size>{len(data)}</Size></Contents>'
+            )
+        common = ''.join(
+            f'<CommonPrefixes><Prefix>{quote_plus(p)}</Prefix>'
+            '</CommonPrefixes>' for p in sorted(prefixes)
+        )
+        return (
+            f'<ListBucketResult xmlns="{S3_NS}"><Name>{escape(bucket)}</Name>'
+            '<EncodingType>url</EncodingType>'
+            f'<IsTruncated>false</IsTruncated>{"".join(contents)}{common}'
+            '</ListBucketResult>'
+        ).encode()
@@ -0,0 +1,285 @@
+"""
+End-to-end load harness: replays recorded (see ``RECORD_UPDATES``)
+or synthesized user sessions against the bot wired to in-process
+fake Telegram and S3 servers, and reports throughput, per-step
+latency percentiles and peak RSS. A step is complete when the bot
+has dispatched its update and finished all handler tasks of the chat.
+
+Run from the repository root, e.g.::
+
+    python -m tests.load.harness --users 20 --photos 3 --rate 5
+    python -m tests.load.harness --replay updates.jsonl --rate 2
+"""
+import argparse
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+
+from tests.load.fakes import FakeS3, FakeTelegram
+
+Step = Tuple[str, Dict]  # step name, update
+
+
+def _message(user_id: int, i: int, **content) -> Dict:
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+    message = {
+        'message_id': i, 'date': int(time.time()), 'from': user,
+        'chat': dict(user, type='private'),
+    }
+    message.update(content)
+    return {'message': message}
+
+
+def synthesize(users: int, photos: int,
+               text: str = 'Hello!', font: str = '/arial',
+               size: str = '/medium') -> List[List[Step]]:
+    """
+    Builds sessions: each user sends ``photos`` photos,
+    a text, a font and a size, and then saves the result.
+
+    :return: list of sessions
+    """
+    sessions = []
+    for user_id in range(1, users + 1):
+        steps = [('start', {'text': '/start'})]
+        for i in range(photos):
+            name = f'{i % 2 + 1}.jpg'  # test images
+            photo = [
+                {'file_id': 'small', 'file_unique_id': 'small',
+                 'width': 90, 'height': 54},
+                {'file_id': name, 'file_unique_id': name,
+                 'width': 600, 'height': 360},
+            ]
+            steps.append(('photo', {'photo': photo}))
+        steps += [
+            ('done', {'text': '/done'}),
+            ('text', {'text': text}),
+            ('font', {'text': font}),
+            ('size', {'text': size}),
+            ('save', {'text': '/save'}),
+        ]
+        sessions.append([
+            (name, _message(user_id, i, **content))
+            for i, (name, content) in enumerate(steps, 1)
+        ])
+    return sessions
+
+
+def load_recorded(path: str) -> List[List[Step]]:
+    """
+    Reads updates recorded as JSONL and groups them
+    into sessions by chat.
+
+    :return: list of sessions
+    """
+    sessions = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            update = json.loads(line)
+            message = update.get('message')
+            if message is None:
+                continue
+            text = message.get('text') or ''
+            if 'photo' in message:
+                name = 'photo'
+            elif text.startswith('/'):
+                name = text.split()[0]
+            elif 'text' in message:
+                name = 'text'
+            else:
+                name = 'other'
+            sessions[message['chat']['id']].append((name, update))
+    return list(sessions.values())
+
+
+class _Activity:
+    """
+    Tracks work of the bot: the last dispatched update
+    and unfinished handler tasks per chat.
+    """
+    def __init__(self):
+        self.dispatched = 0  # update ID
+        self.tasks = defaultdict(int)  # chat ID --> number of tasks
+        self.cond = threading.Condition()
+
+    def dispatch(self, process_new_updates: Callable) -> Callable:
+        def wrapper(updates):
+            try:
+                process_new_updates(updates)
+            finally:
+                with self.cond:
+                    self.dispatched = max(
+                        [self.dispatched] + [u.update_id for u in updates]
+                    )
+                    self.cond.notify_all()
+        return wrapper
+
+    def track(self, exec_task: Callable) -> Callable:
+        def wrapper(task, *args, **kwargs):
+            chat = getattr(args[0], 'chat', None) if args else None
+            if chat is None:
+                return exec_task(task, *args, **kwargs)
+            with self.cond:
+                self.tasks[chat.id] += 1
+
+            def tracked(*args, **kwargs):
+                try:
+                    task(*args, **kwargs)
+                finally:
+                    with self.cond:
+                        self.tasks[chat.id] -= 1
+                        self.cond.notify_all()
+            exec_task(tracked, *args, **kwargs)
+        return wrapper
+
+    def wait(self, chat_id: int, update_id: int, timeout: float) -> bool:
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: (self.dispatched >= update_id
+                         and not self.tasks[chat_id]),
+                timeout
+            )
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(sessions: List[List[Step]], rate: float = 1.0,
+        think: float = 0.05, timeout: float = 60.0) -> Dict:
+    """
+    Replays sessions starting ``rate`` sessions per second.
+    Inside a session each update is sent after the previous
+    step was complete and ``think`` seconds passed.
+
+    :return: report
+    """
+    os.environ.setdefault('TOKEN', 'load:test')
+    os.environ.setdefault('MINIO_API_ADDRESS', 'localhost:9000')  # unused
+    from telebot import apihelper
+
+    import source.bot as app
+    from source.state import StateStore
+    from source.storage import MinioClient, SpooledClient
+
+    activity = _Activity()
+    latencies = defaultdict(list)
+    failed = []
+    with FakeTelegram() as telegram, FakeS3() as s3, \
+            tempfile.TemporaryDirectory() as state_dir:
+        urls = apihelper.API_URL, apihelper.FILE_URL
+        apihelper.API_URL, apihelper.FILE_URL = \
+            telegram.api_url, telegram.file_url
+        client, states = app.client, app.states
+        app.client = SpooledClient(
+            MinioClient(s3.address, 'load', 'load'),
+            os.path.join(state_dir, 'spool'),
+        )
+        app.states = StateStore(state_dir)
+        app.bot.last_update_id = 0  # update IDs of a new fake start from 1
+        app.bot.process_new_updates = activity.dispatch(
+            app.bot.process_new_updates
+        )
+        app.bot._exec_task = activity.track(app.bot._exec_task)
+        polling = threading.Thread(
+            target=app.bot.polling,
+            kwargs=dict(non_stop=True, interval=0, timeout=1,
+                        long_polling_timeout=1),
+            daemon=True,
+        )
+        polling.start()
+
+        def play(session: List[Step]) -> None:
+            for name, update in session:
+                chat_id = update['message']['chat']['id']
+                start = time.perf_counter()
+                update_id = telegram.push(update)
+                if not activity.wait(chat_id, update_id, timeout):
+                    failed.append(chat_id)
+                    return
+                latencies[name].append(time.perf_counter() - start)
+                time.sleep(think)
+
+        players = []
+        started = time.perf_counter()
+        try:
+            for i, session in enumerate(sessions):
+                delay = started + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                player = threading.Thread(target=play, args=(session,))
+                player.start()
+                players.append(player)
+            for player in players:
+                player.join()
+        finally:
+            elapsed = time.perf_counter() - started
+            app.bot.stop_polling()
+            polling.join(timeout=5)
+            del app.bot.process_new_updates, app.bot._exec_task
+            app.states.close()
+            app.client, app.states = client, states
+            apihelper.API_URL, apihelper.FILE_URL = urls
+    completed = len(sessions) - len(failed)
+    return {
+        'sessions': len(sessions),
+        'failed': len(failed),
+        'elapsed': elapsed,
+        'sessions_per_sec': completed / elapsed,
+        'latency': {
+            name: {
+                'p50': _percentile(values, 0.5),
+                'p90': _percentile(values, 0.9),
+                'p99': _percentile(values, 0.99),
+                'max': max(values),
+            } for name, values in latencies.items()
+        },
+        # kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def print_report(report: Dict) -> None:
+    print(f"sessions: {report['sessions']} "
+          f"(failed: {report['failed']}) "
+          f"in {report['elapsed']:.1f} s, "
+          f"{report['sessions_per_sec']:.2f} sessions/s, "
+          f"peak RSS {report['peak_rss_mb']:.0f} MB")
+    print(f"{'step':<10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for name, stats in report['latency'].items():
+        print(f'{name:<10}' + ''.join(
+            f'{stats[q] * 1000:>8.0f}ms' for q in ('p50', 'p90', 'p99', 'max')
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--replay', help='JSONL file with recorded updates')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--photos', type=int, default=2)
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help='sessions started per second')
+    parser.add_argument('--think', type=float, default=0.05,
+                        help='pause between steps of a session (seconds)')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='max wait for a step (seconds)')
+    parser.add_argument('--json', action='store_true',
+                        help='print a report as JSON')
+    args = parser.parse_args()
+
+    if args.replay:
+        sessions = load_recorded(args.replay)
+    else:
+        sessions = synthesize(args.users, args.photos)
+    report = run(sessions, args.rate, args.think, args.timeout)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -1,11 +1,23 @@
+import io
 import re
 import time
+from collections import defaultdict
 from unittest.mock import patch
 
+import pytest
 from telebot import types
 
 from source.bot import bot
 from source.config import MSG
+from source.state import StateStore
+
+
+@pytest.fixture(autouse=True)
+def states(tmp_path):
+    states = StateStore(tmp_path)
+    with patch('source.bot.states', states):
+        yield states
+    states.close()
 
 
 def capture_event(*args, **kwargs):
@@ -27,7 +39,7 @@ def check_reaction(text: str, capsys, msg=None):
     return re.sub('\\\\n', "\\n", captured.out)
 
 
-class FakeObj:
+class FakeObj(io.BytesIO):
     format = 'GIF'
     name = ''.join(['test', format])
 
@@ -38,7 +50,7 @@ class FakeClient:
         return None
 
 
-@patch('telebot.TeleBot.register_next_step_handler', return_value=None)
+@patch('source.bot.register_step', return_value=None)
 @patch('telebot.TeleBot.send_message', side_effect=capture_event)
 class TestBot:
     def test_command_start(self, mock1, mock2, capsys):
@@ -64,6 +76,21 @@ class TestBot:
         captured = capsys.readouterr()
         assert MSG.restart in captured.out
 
+    @patch('source.bot.process_photo', return_value=None)
+    def test_photo_handler(self, mock1, mock2, mock3, capsys):
+        from source.bot import photo_handler
+
+        msg = create_text_message('')
+        msg.photo = [1]
+        with patch('source.bot.IMAGES', defaultdict(list)) as images:
+            photo_handler(msg)
+            assert MSG.text in capsys.readouterr().out
+            mock1.assert_not_called()  # not kept outside of GIF creation
+
+            images[msg.from_user.id] = []
+            photo_handler(msg)
+            mock1.assert_called_once_with(msg)
+
     @patch('source.bot.process_photo', return_value=None)
     @patch('telebot.types.Message.parse_photo', return_value=[1])
     def test_process_photo_step(self, mock1, mock2, mock3, mock4, capsys):
@@ -125,18 +152,153 @@ class TestBot:
     @patch(
         'source.transformer.ImageTransformer.transform', return_value=FakeObj()
     )
-    def test_send_result_step(self, mock1, mock2, mock3, mock4, mock5, capsys):
-        from source.bot import send_result_step, upload_result_step
+    def test_send_result_step(self, mock1, mock2, mock3, mock4, mock5,
+                              capsys, states):
+        from source.bot import (IMAGES, RESULTS, send_result_step,
+                                upload_result_step)
 
         msg = create_text_message('')
+        IMAGES[msg.from_user.id].images.append(1)
         send_result_step(msg)
         assert MSG.finish in check_reaction('', capsys)
+        assert msg.from_user.id not in IMAGES  # frames are freed
 
-        obj = FakeObj()
+        key = mock5.call_args.args[2]
+        assert key == f'{msg.chat.id}_{FakeObj.name}'
+        RESULTS.pop(msg.chat.id)  # as after a restart
         msg.text = '/publish'
-        upload_result_step(msg, obj)
+        upload_result_step(msg, key)
         assert MSG.saved in check_reaction('', capsys)
+        assert mock3.upload.call_args.args[1].name == FakeObj.name
+        assert states.get_blob(key) is None
 
+        obj = FakeObj()
+        RESULTS[msg.chat.id] = obj
         msg.text = '/save'
-        upload_result_step(msg, obj)
+        upload_result_step(msg, obj.name)
         assert MSG.saved in check_reaction('', capsys)
+
+        msg.text = '/save'
+        upload_result_step(msg, obj.name)  # nothing to upload
+        assert MSG.text in check_reaction('', capsys)
+
+    @patch('source.bot.send_batch', return_value=None)
+    def test_choose_content_step(self, mock1, mock2, mock3, capsys):
+        from source.bot import CONTENT, choose_content_step
+
+        msg = create_text_message('1')
+        CONTENT[msg.chat.id] = [('3-public', 'test.GIF')]
+        choose_content_step(msg)
+        mock1.assert_called_once_with(msg, [], [1])
+
+        for text in ['test', '\u00b2', '5', '']:  # nothing to choose
+            CONTENT[msg.chat.id] = [('3-public', 'test.GIF')]
+            msg.text = text
+            choose_content_step(msg)
+            assert MSG.text in capsys.readouterr().out
+            assert msg.chat.id not in CONTENT
+        assert mock1.call_count == 1
+
+        CONTENT[msg.chat.id] = [('3-public', 'test.GIF')]
+        msg.text = '/restart'
+        choose_content_step(msg)
+        assert MSG.restart in capsys.readouterr().out
+        assert msg.chat.id not in CONTENT
+
+    @patch('source.bot.ADMIN_IDS', [11])
+    def test_command_profile(self, mock1, mock2, capsys):
+        from source.bot import profiler
+
+        assert MSG.profile_usage in check_reaction('/profile', capsys)
+        for arg in ['nan', 'inf']:
+            text = check_reaction(f'/profile {arg}', capsys)
+            assert MSG.profile_usage in text
+        assert not profiler.rate
+        assert MSG.profile.format(5) in check_reaction('/profile 5', capsys)
+        assert profiler.rate == 0.05
+        assert MSG.profile.format(0) in check_reaction('/profile 0', capsys)
+        assert not profiler.rate
+
+    @patch('source.bot.ADMIN_IDS', [11])
+    def test_command_stats(self, mock1, mock2, capsys):
+        assert 'Photos: ' in check_reaction('/stats', capsys)
+
+
+def test_next_step_handlers_of_a_batch():
+    calls = []
+    messages = [create_text_message('test') for _ in range(3)]
+    for i, msg in enumerate(messages):
+        msg.chat = types.User(100 + i, False, 'test')
+        bot.register_next_step_handler(msg, calls.append)
+    bot.process_new_messages(list(messages))
+    time.sleep(1)
+    assert sorted(m.chat.id for m in calls) == [100, 101, 102]
+
+
+@patch('telebot.TeleBot.download_file', return_value=b'bytes')
+@patch('telebot.TeleBot.get_file')
+@patch('telebot.TeleBot.send_message')
+def test_photos_of_a_batch(mock1, mock2, mock3):
+    from source.bot import start
+
+    def photo_message():
+        msg = create_text_message('')
+        msg.chat = msg.from_user = types.User(200, False, 'test')
+        msg.content_type = 'photo'
+        msg.photo = [types.PhotoSize('x', 'x', 800, 533, 90000)]
+        return msg
+
+    mock1.return_value = photo_message()  # to register steps
+    with patch('source.bot.IMAGES', defaultdict(list)) as images:
+        start(photo_message())
+        # the second photo arrives before the next step is registered
+        bot.process_new_messages([photo_message(), photo_message()])
+        time.sleep(3)
+    bot.clear_step_handler_by_chat_id(200)
+
+    assert images[200] == [b'bytes', b'bytes']
+    assert MSG.text not in [call.args[1] for call in mock1.call_args_list]
+
+
+@patch('telebot.TeleBot.download_file', return_value=b'bytes')
+@patch('telebot.TeleBot.get_file')
+def test_process_photo(mock1, mock2):
+    from source.bot import STATS, process_photo
+
+    msg = create_text_message('')
+    msg.photo = [
+        types.PhotoSize(name, name, width, height, file_size)
+        for name, width, height, file_size in [
+            ('m', 320, 213, 20000), ('x', 800, 533, 90000),
+            ('y', 1280, 853, 200000), ('w', 2560, 1706, 600000),
+        ]
+    ]
+    stats = STATS.snapshot()
+    with patch('source.bot.IMAGES', defaultdict(list)) as images:
+        process_photo(msg)
+
+    mock1.assert_called_once_with('x')
+    assert images[msg.from_user.id] == [b'bytes']
+    assert STATS['photos'] - stats.get('photos', 0) == 1
+    assert STATS['photo_bytes'] - stats.get('photo_bytes', 0) == 5
+    assert STATS['photo_bytes_saved'] - stats.get(
+        'photo_bytes_saved', 0) == 600000 - 90000
+
+
+def test_restore_steps(states):
+    from source.bot import restore_steps
+
+    obj = io.BytesIO(b'test')
+    states.set(300, 'upload_result_step', ['300_1.GIF'])
+    states.set(301, 'send_batch', [['1'], 0])
+    for key in ['300_1.GIF', '302_1.GIF']:
+        states.put_blob(key, obj)
+    try:
+        restore_steps()
+        for chat_id in [300, 301]:
+            assert bot.next_step_backend.get_handlers(chat_id)
+    finally:
+        for chat_id in [300, 301]:
+            bot.clear_step_handler_by_chat_id(chat_id)
+    assert states.get_blob('300_1.GIF') is not None
+    assert states.get_blob('302_1.GIF') is None
@@ -0,0 +1,39 @@
+import json
+
+from tests.load.harness import _message, load_recorded, run, synthesize
+
+
+def test_load_harness():
+    sessions = synthesize(users=1, photos=1)
+    report = run(sessions, rate=10, timeout=30)
+
+    assert report['sessions'] == 1
+    assert report['failed'] == 0
+    assert list(report['latency']) == [
+        'start', 'photo', 'done', 'text', 'font', 'size', 'save'
+    ]
+    assert report['peak_rss_mb'] > 0
+
+
+def test_load_harness_concurrent_users():
+    sessions = synthesize(users=5, photos=2)
+    report = run(sessions, rate=5, timeout=60)
+
+    assert report['sessions'] == 5
+    assert report['failed'] == 0
+
+
+def test_load_harness_recorded(tmp_path):
+    # a stray size command and a message without a handler
+    updates = [
+        _message(1, 1, text='/help'),
+        _message(1, 2, text='/large'),
+        _message(1, 3, location={'latitude': 0.0, 'longitude': 0.0}),
+        _message(1, 4, text='/help'),
+    ]
+    path = tmp_path / 'updates.jsonl'
+    path.write_text(''.join(json.dumps(u) + '\n' for u in updates))
+    report = run(load_recorded(str(path)), rate=10, timeout=10)
+
+    assert report['failed'] == 0
+    assert list(report['latency']) == ['/help', '/large', 'other']
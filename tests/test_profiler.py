@@ -0,0 +1,73 @@
+import pstats
+import threading
+from unittest.mock import patch
+
+from source.profiler import Profiler
+
+
+def test_profiler(tmp_path):
+    profiler = Profiler(tmp_path)
+
+    @profiler.profile('job', lambda x: {'x': x, 'font': 'arial'})
+    def job(x):
+        return sum(range(x))
+
+    assert job(10) == 45
+    assert not list(tmp_path.iterdir())  # disabled
+
+    profiler.enable(1)
+    assert job(10) == 45
+    profiles = list(tmp_path.iterdir())
+    assert len(profiles) == 1
+    assert profiles[0].name.endswith('-job-x=10-font=arial.prof')
+    assert pstats.Stats(str(profiles[0])).total_calls > 0
+
+    profiler.disable()
+    job(10)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    profiler.enable(float('nan'))
+    assert not profiler.rate
+
+
+def test_profiler_concurrent_jobs(tmp_path):
+    profiler = Profiler(tmp_path)
+    profiler.enable(1)
+    started, release = threading.Barrier(3), threading.Event()
+    results, errors = [], []
+
+    @profiler.profile('job')
+    def job():
+        started.wait(timeout=5)
+        release.wait(timeout=5)
+        return 1
+
+    def run():
+        try:
+            results.append(job())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert results == [1, 1, 1]
+    assert len(list(tmp_path.iterdir())) == 1  # only one job sampled
+
+
+def test_profiler_another_tool_active(tmp_path):
+    profiler = Profiler(tmp_path)
+    profiler.enable(1)
+
+    @profiler.profile('job')
+    def job():
+        return 1
+
+    with patch('cProfile.Profile.enable',
+               side_effect=ValueError('Another profiling tool')):
+        assert job() == 1
+    assert not list(tmp_path.iterdir())
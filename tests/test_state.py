@@ -0,0 +1,36 @@
+import io
+
+from source.state import StateStore
+
+
+def test_state_store(tmp_path):
+    states = StateStore(tmp_path, flush_size=3, flush_interval=60)
+
+    states.set(1, 'process_photo_step')
+    states.set(2, 'send_batch', [['1', '2'], 2])
+    states.drop(1)
+    assert states._pending  # not flushed yet
+    states.set(3, 'upload_result_step', ['3.GIF'])
+    assert not states._pending  # batch is full
+
+    states.close()
+    states = StateStore(tmp_path)
+    assert states.load() == {
+        2: ('send_batch', [['1', '2'], 2]),
+        3: ('upload_result_step', ['3.GIF']),
+    }
+
+    obj = io.BytesIO(b'test')
+    states.put_blob('3.GIF', obj)
+    blob = states.get_blob('3.GIF')
+    assert blob.getvalue() == b'test'
+    assert blob.name == '3.GIF'
+    states.delete_blob('3.GIF')
+    assert states.get_blob('3.GIF') is None
+
+    for key in ['3.GIF', '4.GIF']:
+        states.put_blob(key, obj)
+    assert states.prune_blobs(['3.GIF']) == 1
+    assert states.get_blob('3.GIF') is not None
+    assert states.get_blob('4.GIF') is None
+    states.close()
@@ -3,7 +3,14 @@ import io
 from collections import defaultdict
 from unittest.mock import patch
 
-from source.storage import MinioClient
+import pytest
+from minio.error import S3Error
+from PIL import Image, UnidentifiedImageError
+from urllib3.exceptions import MaxRetryError
+
+from source.config import SPOOL_MAX_ATTEMPTS, THUMB_PREFIX
+from source.storage import (CircuitBreaker, MinioClient, SpooledClient,
+                            StorageUnavailable)
 
 
 class FakeResponse:
@@ -60,20 +67,28 @@ class FakeClient:
             return self.buckets[self.bucket_dict[bucket_name]][obj_name]
         return
 
-    def list_objects(self, bucket_name):
+    def list_objects(self, bucket_name, prefix=''):
         print(bucket_name)
         if self.bucket_exists(bucket_name):
             print(self.buckets[self.bucket_dict[bucket_name]].values())
-            return self.buckets[self.bucket_dict[bucket_name]].values()
+            return [
+                obj for obj in
+                self.buckets[self.bucket_dict[bucket_name]].values()
+                if obj.object_name.startswith(prefix)
+            ]
         return []
 
+    def remove_object(self, bucket_name: str, obj_name: str):
+        del self.buckets[self.bucket_dict[bucket_name]][obj_name]
+
 
 @patch('source.storage.Minio', return_value=FakeClient())
 def test_minio_client(mock):
     client = MinioClient()
 
     for i, private in zip([1, 2, 3], [True, True, False]):
-        obj_bytes = io.BytesIO(f'test_{i}'.encode())
+        obj_bytes = io.BytesIO()
+        Image.new('RGB', (400, 300), 'red').save(obj_bytes, 'gif')
         obj_bytes.name = f'test_{i}.GIF'
         client.upload(user_id=i, obj=obj_bytes, private=private)
     assert len(client.client.buckets) == 3
@@ -86,3 +101,120 @@ def test_minio_client(mock):
 
     content = client.download_all_content(['1', '2'])
     assert len(content) == 0
+
+    keys = client.list_content(['3'])
+    assert len(keys) == 1
+    thumbs = client.download_thumbnails(keys)
+    assert Image.open(thumbs[0]).size == (160, 120)
+    assert client.download_content(keys)[0].name == keys[0][1]
+
+    assert client.backfill_thumbnails() == 0
+    client.client.remove_object(keys[0][0], THUMB_PREFIX + keys[0][1])
+    assert client.backfill_thumbnails() == 1
+
+
+@patch('source.storage.Minio', return_value=FakeClient())
+def test_minio_client_thumbnail_errors(mock):
+    client = MinioClient()
+
+    def error(code):
+        return S3Error(code, code, '/', '', '', None)
+
+    with patch.object(client, '_get_object') as get_object, \
+            patch.object(client, '_put_thumbnail') as put_thumbnail:
+        get_object.side_effect = [error('NoSuchKey'), io.BytesIO()]
+        assert client._get_thumbnail('1-public', 'test.GIF') is \
+            put_thumbnail.return_value
+
+        put_thumbnail.reset_mock()
+        get_object.side_effect = [error('AccessDenied')]
+        with pytest.raises(S3Error):
+            client._get_thumbnail('1-public', 'test.GIF')
+        put_thumbnail.assert_not_called()
+
+
+class FlakyClient:
+    """
+    Fake MinioClient whose storage can be switched off.
+    """
+    def __init__(self):
+        self.available = False
+        self.calls = 0
+        self.attempted = []  # creation times
+        self.uploaded = []
+
+    def _check(self):
+        self.calls += 1
+        if isinstance(self.available, Exception):
+            raise self.available
+        if not self.available:
+            raise MaxRetryError(None, '/', 'storage is down')
+
+    def upload(self, user_id, obj, private=False, created=None):
+        self.attempted.append(created)
+        self._check()
+        self.uploaded.append((user_id, obj.name, obj.getvalue(), created))
+
+    def list_content(self, user_id_list=[]):
+        self._check()
+        return []
+
+
+def test_spooled_client(tmp_path):
+    flaky = FlakyClient()
+    client = SpooledClient(
+        flaky, tmp_path, CircuitBreaker(threshold=2, reset_timeout=60)
+    )
+
+    for i in range(3):
+        obj = io.BytesIO(f'test_{i}'.encode())
+        obj.name = f'test_{i}.GIF'
+        assert not client.upload(i, obj, private=True)
+    assert client.breaker.is_open
+    assert flaky.calls == 2  # the third upload failed fast
+    assert len(client.spooled()) == 3
+
+    with pytest.raises(StorageUnavailable):
+        client.list_content()
+    assert client.replay() == 0
+    assert flaky.calls == 2
+
+    flaky.available = True
+    client.breaker.reset_timeout = 0  # let a trial call through
+    assert client.replay() == 3
+    assert not client.breaker.is_open
+    assert not list(tmp_path.iterdir())
+    assert sorted(x[:3] for x in flaky.uploaded) == [
+        (i, f'test_{i}.GIF', f'test_{i}'.encode()) for i in range(3)
+    ]
+    # replays keep object names of the first attempts
+    assert set(flaky.attempted[:2]) < {x[3] for x in flaky.uploaded}
+    assert client.upload(1, obj)
+
+
+def test_spooled_client_dead_letter(tmp_path):
+    flaky = FlakyClient()
+    client = SpooledClient(
+        flaky, tmp_path, CircuitBreaker(threshold=2, reset_timeout=0)
+    )
+    obj = io.BytesIO(b'test')
+    obj.name = 'test.GIF'
+    assert not client.upload(1, obj)
+    (tmp_path / 'corrupt.data').write_bytes(b'test')
+    (tmp_path / 'corrupt.json').write_text('{')
+
+    # errors other than an unreachable storage are not spooled
+    flaky.available = UnidentifiedImageError('cannot identify image')
+    with pytest.raises(UnidentifiedImageError):
+        client.upload(1, obj)
+    assert not client.breaker.is_open
+
+    assert client.replay() == 0  # a corrupt entry is moved at once
+    assert len(client.spooled()) == 1
+    for _ in range(SPOOL_MAX_ATTEMPTS - 1):
+        assert client.replay() == 0
+    assert len(client.spooled()) == 0
+    assert not client.breaker.is_open
+    dead = sorted(path.suffix for path in (tmp_path / 'dead').iterdir())
+    assert dead == ['.data', '.data', '.json', '.json']
+    assert (tmp_path / 'dead' / 'corrupt.json').exists()
@@ -1,12 +1,13 @@
 import io
 import os
 
-from PIL import Image
+from PIL import Image, ImageFont
 from telebot import types
 
 from source.config import IMAGES, SETTINGS
-from source.transformer import ImageTransformer
-from source.utils import Settings
+from source.transformer import (ImageTransformer, make_contact_sheet,
+                                make_thumbnail)
+from source.utils import Frames, Settings
 
 
 def find_test_file(name):
@@ -22,7 +23,6 @@ with open(find_test_file('1.jpg'), "rb") as image:
 
 with open(find_test_file('2.jpg'), "rb") as image:
     im2 = image.read()
-IMAGES['test_user'] = [im1, im2]
 
 
 im3 = Image.open(find_test_file('3.gif'))
@@ -41,6 +41,8 @@ SETTINGS['test_user'] = s
 
 
 def test_image_transformer():
+    for img in [im1, im2]:
+        IMAGES['test_user'].append(img)
     transformer = ImageTransformer('test_user')
 
     assert transformer.width == 700
@@ -65,3 +67,35 @@ def test_image_transformer():
 
     del SETTINGS['test_user']
     del IMAGES['test_user']
+
+
+def test_contact_sheet():
+    thumbs = [make_thumbnail(io.BytesIO(img)) for img in [im1, im2] * 3]
+    assert all(max(Image.open(t).size) <= 160 for t in thumbs)
+
+    sheet = Image.open(make_contact_sheet(thumbs, start=7))
+    assert sheet.size == (5 * 160, 2 * 160)
+
+
+def test_fit_font():
+    SETTINGS['test_user'] = s
+    IMAGES['test_user'].append(im1)
+    transformer = ImageTransformer('test_user')
+    for width in [1, 100, 600]:
+        font = transformer._fit_font(width)
+        target = transformer.img_fraction * width
+        assert font.getsize('test')[0] >= target
+        smaller = ImageFont.truetype(font.path, font.size - 1)
+        assert font.size == 1 or smaller.getsize('test')[0] < target
+    del SETTINGS['test_user']
+    del IMAGES['test_user']
+
+
+def test_frames():
+    frames = Frames((400, 400))
+    for img in [im1, im2, im1]:
+        frames.append(img)
+    assert len(frames) == 3
+    assert all(img.mode == 'RGB' for img in frames)
+    assert [img.size for img in frames] == [(400, 240), (400, 300), (400, 240)]
+    assert (frames.width, frames.height) == (400, 300)
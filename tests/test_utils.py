@@ -0,0 +1,40 @@
+import threading
+
+from telebot import types
+
+from source.utils import Counters, choose_photo_size
+
+
+def test_choose_photo_size():
+    photo = [
+        types.PhotoSize(name, name, width, height)
+        for name, width, height in [
+            ('s', 90, 60), ('m', 320, 213), ('x', 800, 533),
+            ('y', 1280, 853), ('w', 2560, 1706),
+        ]
+    ]
+    assert choose_photo_size(photo, (1280, 1280)).file_id == 'y'
+    assert choose_photo_size(photo, (800, 800)).file_id == 'x'
+    assert choose_photo_size(photo, (500, 200)).file_id == 'm'
+    assert choose_photo_size(photo[:3], (1280, 1280)).file_id == 'x'
+
+    portrait = [types.PhotoSize('p', 'p', 853, 1280)]
+    assert choose_photo_size(portrait, (1280, 1280)).file_id == 'p'
+
+
+def test_counters():
+    counters = Counters()
+
+    def add():
+        for _ in range(10000):
+            counters.add('photos')
+            counters.add('photo_bytes', 2)
+
+    threads = [threading.Thread(target=add) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counters['photos'] == 40000
+    assert counters.snapshot() == {'photos': 40000, 'photo_bytes': 80000}
+    assert counters['other'] == 0